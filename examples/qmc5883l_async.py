@@ -0,0 +1,31 @@
+# SPDX-FileCopyrightText: Copyright (c) 2023 Jose D. Montoya
+#
+# SPDX-License-Identifier: MIT
+
+import asyncio
+from machine import Pin, I2C
+from micropython_qmc5883l import qmc5883l
+
+i2c = I2C(1, sda=Pin(2), scl=Pin(3))  # Correct I2C pins for RP2040
+qmc = qmc5883l.QMC5883L(i2c)  # Pass drdy_pin=<pin> to await the DRDY interrupt
+
+
+async def read_magnetic():
+    while True:
+        mag_x, mag_y, mag_z = await qmc.magnetic_async()
+        print(f"x:{mag_x:.2f}Gs, y:{mag_y:.2f}Gs, z{mag_z:.2f}Gs")
+        await asyncio.sleep(0.3)
+
+
+async def blink():
+    led = Pin("LED", Pin.OUT)
+    while True:
+        led.toggle()
+        await asyncio.sleep(0.5)
+
+
+async def main():
+    await asyncio.gather(read_magnetic(), blink())
+
+
+asyncio.run(main())
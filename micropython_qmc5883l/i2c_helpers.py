@@ -112,22 +112,51 @@ class RegisterStruct:
         obj,
         objtype=None,
     ):
+        # readfrom_mem addresses the register and reads it back in a single
+        # repeated-start transaction
+        value = struct.unpack(
+            self.format,
+            obj._i2c.readfrom_mem(obj._address, self.register, self.lenght),
+        )
         if self.lenght <= 2:
-            value = struct.unpack(
-                self.format,
-                memoryview(
-                    obj._i2c.readfrom_mem(obj._address, self.register, self.lenght)
-                ),
-            )[0]
-        else:
-            value = struct.unpack(
-                self.format,
-                memoryview(
-                    obj._i2c.readfrom_mem(obj._address, self.register, self.lenght)
-                ),
-            )
+            return value[0]
         return value
 
     def __set__(self, obj, value):
         mem_value = value.to_bytes(self.lenght, "big")
         obj._i2c.writeto_mem(obj._address, self.register, mem_value)
+
+
+class ShadowBits:
+    """
+    Changes bits from a byte register kept in a shadow attribute of the
+    object. The register is written back whole, without reading it first
+    """
+
+    def __init__(
+        self,
+        num_bits: int,
+        register_address: int,
+        start_bit: int,
+        shadow: str,
+    ) -> None:
+        self.bit_mask = ((1 << num_bits) - 1) << start_bit
+        self.register = register_address
+        self.start_bit = start_bit
+        self.shadow = shadow
+
+    def __get__(
+        self,
+        obj,
+        objtype=None,
+    ) -> int:
+        if obj is None:
+            return self
+        return (getattr(obj, self.shadow) & self.bit_mask) >> self.start_bit
+
+    def __set__(self, obj, value: int) -> None:
+        reg = getattr(obj, self.shadow) & ~self.bit_mask
+        reg |= value << self.start_bit
+        setattr(obj, self.shadow, reg)
+
+        obj._i2c.writeto_mem(obj._address, self.register, bytes((reg,)))
@@ -12,18 +12,44 @@ MicroPython Driver for the QMC5883L Accelerometer
 
 
 """
-
+# pylint: disable=too-many-arguments
 import time
+import struct
+import array
+from machine import Pin, idle, disable_irq, enable_irq
 from micropython import const
-from micropython_qmc5883l.i2c_helpers import CBits, RegisterStruct
+from micropython_qmc5883l.i2c_helpers import RegisterStruct, ShadowBits
+
+try:
+    from micropython_qmc5883l.viper_helpers import scale as _scale
+except (ImportError, NameError, SyntaxError):
+
+    def _scale(src, out, n: int, mul: int) -> None:
+        for i in range(n):
+            out[i] = src[i] * mul
+
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+try:
+    from ulab import numpy as np
+except ImportError:
+    np = None
 
 __version__ = "0.0.0+auto.0"
 __repo__ = "https://github.com/jposada202020/MicroPython_QMC5883L.git"
 
+_REG_DATA = const(0x00)
+_REG_STATUS = const(0x06)
 _REG_WHOAMI = const(0x0D)
-_REG_SET_RESET = const(0x0B)
 _REG_OPERATION_MODE = const(0x09)
-_REG_STATUS = const(0x06)
+_REG_CONTROL_2 = const(0x0A)
+
+_DATA_READY = const(0x01)
+_FIXED_SHIFT = const(24)
 
 OVERSAMPLE_64 = const(0b11)
 OVERSAMPLE_128 = const(0b10)
@@ -34,6 +60,7 @@ oversample_values = (OVERSAMPLE_64, OVERSAMPLE_128, OVERSAMPLE_256, OVERSAMPLE_5
 FIELDRANGE_2G = const(0b00)
 FIELDRANGE_8G = const(0b01)
 field_range_values = (FIELDRANGE_2G, FIELDRANGE_8G)
+_RES_FOR_RANGE = (12000, 3000)
 
 OUTPUT_DATA_RATE_10 = const(0b00)
 OUTPUT_DATA_RATE_50 = const(0b01)
@@ -52,12 +79,40 @@ mode_values = (MODE_STANDBY, MODE_CONTINUOUS)
 
 RESET_VALUE = const(0b01)
 
+_OVERSAMPLE_SET = frozenset(oversample_values)
+_FIELD_RANGE_SET = frozenset(field_range_values)
+_DATA_RATE_SET = frozenset(data_rate_values)
+_MODE_SET = frozenset(mode_values)
+
+_OVERSAMPLE_NAMES = (
+    "OVERSAMPLE_512",
+    "OVERSAMPLE_256",
+    "OVERSAMPLE_128",
+    "OVERSAMPLE_64",
+)
+_FIELD_RANGE_NAMES = ("FIELDRANGE_2G", "FIELDRANGE_8G")
+_DATA_RATE_NAMES = (
+    "OUTPUT_DATA_RATE_10",
+    "OUTPUT_DATA_RATE_50",
+    "OUTPUT_DATA_RATE_100",
+    "OUTPUT_DATA_RATE_200",
+)
+_MODE_NAMES = ("MODE_STANDBY", "MODE_CONTINUOUS")
+
 
 class QMC5883L:
     """Driver for the QMC5883L Sensor connected over I2C.
 
     :param ~machine.I2C i2c: The I2C bus the QMC5883L is connected to.
     :param int address: The I2C device address. Defaults to :const:`0xD`
+    :param drdy_pin: Pin id connected to the sensor DRDY output. When given, reads
+     wait for the data ready interrupt instead of polling the bus. Defaults to `None`
+    :param int max_age: Maximum age in milliseconds of the cached reading returned by
+     :meth:`magnetic_nowait` before it tries the bus again. ``0`` tries on every call,
+     ``-1`` means the user controls fetch. Defaults to :const:`0`
+    :param int buffer_size: Number of recent samples kept in a ring buffer filled
+     from the DRDY interrupt, see :meth:`samples`. Requires ``drdy_pin``.
+     Defaults to :const:`0` (no buffer)
 
     :raises RuntimeError: if the sensor is not found
 
@@ -87,27 +142,130 @@ class QMC5883L:
     """
 
     _device_id = RegisterStruct(_REG_WHOAMI, "H")
-    _reset = RegisterStruct(_REG_SET_RESET, "H")
-    _conf_reg = RegisterStruct(_REG_OPERATION_MODE, "H")
-    _oversample = CBits(2, _REG_OPERATION_MODE, 6)
-    _field_range = CBits(2, _REG_OPERATION_MODE, 4)
-    _output_data_rate = CBits(2, _REG_OPERATION_MODE, 2)
-    _mode_control = CBits(2, _REG_OPERATION_MODE, 0)
-    _data_ready_register = CBits(1, _REG_STATUS, 2)
-    _measures = RegisterStruct(0x00, "<hhhBh")
-
-    def __init__(self, i2c, address: int = 0xD) -> None:
+    _oversample = ShadowBits(2, _REG_OPERATION_MODE, 6, "_opmode")
+    _field_range = ShadowBits(2, _REG_OPERATION_MODE, 4, "_opmode")
+    _output_data_rate = ShadowBits(2, _REG_OPERATION_MODE, 2, "_opmode")
+    _mode_control = ShadowBits(2, _REG_OPERATION_MODE, 0, "_opmode")
+
+    def __init__(
+        self,
+        i2c,
+        address: int = 0xD,
+        drdy_pin=None,
+        max_age: int = 0,
+        buffer_size: int = 0,
+    ) -> None:
         self._i2c = i2c
         self._address = address
+        self._max_age = max_age
+        self._last = None
+        # STATUS and X/Y/Z data registers, reused by every read
+        self._status = bytearray(1)
+        self._buf = bytearray(6)
 
         if self._device_id != 0xFF:
             raise RuntimeError("Failed to find the QMC5883L!")
-        self._reset = 0x01
 
-        self.oversample = OVERSAMPLE_128
-        self.field_range = FIELDRANGE_2G
-        self.output_data_rate = OUTPUT_DATA_RATE_200
-        self.mode_control = MODE_CONTINUOUS
+        # Every field of the register is set here, so there is nothing to read
+        self._opmode = self._compose_opmode(
+            0,
+            OVERSAMPLE_128,
+            FIELDRANGE_2G,
+            OUTPUT_DATA_RATE_200,
+            MODE_CONTINUOUS,
+        )
+        # Following the datasheet setup sequence, Control 2 (0x0A) and the
+        # SET/RESET period (0x0B) are written, in one transaction, before
+        # Control 1 (0x09) starts continuous conversions. Control 2 at 0 keeps
+        # the DRDY pin enabled, without pointer roll-over or soft reset
+        self._i2c.writeto_mem(self._address, _REG_CONTROL_2, bytes((0x00, RESET_VALUE)))
+        self._i2c.writeto_mem(
+            self._address, _REG_OPERATION_MODE, bytes((self._opmode,))
+        )
+
+        if buffer_size and drdy_pin is None:
+            raise ValueError("buffer_size requires a DRDY pin")
+        self._ring_size = buffer_size
+        # One array per axis, so consumers get unit stride access
+        self._xs = array.array("h", [0] * buffer_size)
+        self._ys = array.array("h", [0] * buffer_size)
+        self._zs = array.array("h", [0] * buffer_size)
+        self._irq_buf = bytearray(6)
+        self._bias = None
+        self._soft_iron = None
+        self._head = 0
+        self._count = 0
+
+        self._ready = False
+        self._drdy_flag = None
+        if drdy_pin is not None:
+            self._drdy_flag = asyncio.ThreadSafeFlag()
+            self._drdy = Pin(drdy_pin, Pin.IN)
+            self._drdy.irq(trigger=Pin.IRQ_RISING, handler=self._on_drdy)
+            # DRDY may already be high, in which case no rising edge will come
+            self._ready = bool(self._drdy.value())
+
+        # The reader is built here, once the DRDY mode is known
+        self._set_resolution(FIELDRANGE_2G)
+
+    def _on_drdy(self, _pin) -> None:
+        if self._ring_size:
+            head = self._head
+            self._i2c.readfrom_mem_into(self._address, _REG_DATA, self._irq_buf)
+            (
+                self._xs[head],
+                self._ys[head],
+                self._zs[head],
+            ) = struct.unpack_from("<hhh", self._irq_buf)
+            self._head = (head + 1) % self._ring_size
+            if self._count < self._ring_size:
+                self._count += 1
+        self._ready = True
+        self._drdy_flag.set()
+
+    def _update(self, x: int, y: int, z: int):
+        inv = self._inv_resolution
+        x, y, z = x * inv, y * inv, z * inv
+        self._last = (x, y, z, time.ticks_ms())  # pylint: disable=no-member
+
+        return x, y, z
+
+    def _read_data(self) -> None:
+        self._i2c.readfrom_mem_into(self._address, _REG_DATA, self._buf)
+
+    def _try_read(self) -> bool:
+        # Reading a data register resets DRDY, so STATUS is read on its own and
+        # the data only once it is ready. A sample that completes mid-poll is
+        # then picked up by the next poll instead of being consumed unseen
+        self._i2c.readfrom_mem_into(self._address, _REG_STATUS, self._status)
+        if not self._status[0] & _DATA_READY:
+            return False
+        self._read_data()
+
+        return True
+
+    def _read_raw(self):
+        readinto = self._i2c.readfrom_mem_into
+        address = self._address
+        buf = self._buf
+        if self._drdy_flag is not None:
+            while not self._ready:
+                idle()
+            self._ready = False
+        else:
+            status = self._status
+            readinto(address, _REG_STATUS, status)
+            while not status[0] & _DATA_READY:
+                time.sleep_ms(1)  # pylint: disable=no-member
+                readinto(address, _REG_STATUS, status)
+        readinto(address, _REG_DATA, buf)
+
+        return struct.unpack_from("<hhh", buf)
+
+    def _read_burst(self):
+        self._read_data()
+
+        return self._update(*struct.unpack_from("<hhh", self._buf))
 
     @property
     def oversample(self) -> int:
@@ -145,18 +303,11 @@ class QMC5883L:
 
         """
 
-        oversamples = (
-            "OVERSAMPLE_512",
-            "OVERSAMPLE_256",
-            "OVERSAMPLE_128",
-            "OVERSAMPLE_64",
-        )
-
-        return oversamples[self._oversample]
+        return _OVERSAMPLE_NAMES[self._oversample]
 
     @oversample.setter
     def oversample(self, value: int) -> None:
-        if value not in oversample_values:
+        if value not in _OVERSAMPLE_SET:
             raise ValueError("Value must be a valid oversample setting")
 
         self._oversample = value
@@ -195,22 +346,53 @@ class QMC5883L:
 
         """
 
-        ranges = ("FIELDRANGE_2G", "FIELDRANGE_8G")
-
-        return ranges[self._field_range]
+        return _FIELD_RANGE_NAMES[self._field_range]
 
     @field_range.setter
     def field_range(self, value: int) -> None:
-        if value not in field_range_values:
+        if value not in _FIELD_RANGE_SET:
             raise ValueError("Value must be a valid field range setting")
 
-        if value == 1:
-            self.resolution = 3000
-        else:
-            self.resolution = 12000
-
+        self._set_resolution(value)
         self._field_range = value
 
+    def _set_resolution(self, field_range: int) -> None:
+        self.resolution = _RES_FOR_RANGE[field_range]
+        self._inv_resolution = 1.0 / self.resolution
+        self._q = (1 << _FIXED_SHIFT) // self.resolution
+        self._read = self._make_reader(self._inv_resolution)
+
+    def _make_reader(self, inv: float):
+        # The reciprocal and the DRDY mode are fixed until the next field range
+        # change, so they are bound as closure locals with the bus accessors
+        # instead of looked up on every read
+        readinto = self._i2c.readfrom_mem_into
+        address = self._address
+        status = self._status
+        buf = self._buf
+        drdy = self._drdy_flag is not None
+        sleep_ms = time.sleep_ms  # pylint: disable=no-member
+        ticks_ms = time.ticks_ms  # pylint: disable=no-member
+
+        def read():
+            if drdy:
+                while not self._ready:
+                    idle()
+                self._ready = False
+            else:
+                readinto(address, _REG_STATUS, status)
+                while not status[0] & _DATA_READY:
+                    sleep_ms(1)
+                    readinto(address, _REG_STATUS, status)
+            readinto(address, _REG_DATA, buf)
+            x, y, z = struct.unpack_from("<hhh", buf)
+            x, y, z = x * inv, y * inv, z * inv
+            self._last = (x, y, z, ticks_ms())
+
+            return x, y, z
+
+        return read
+
     @property
     def output_data_rate(self) -> int:
         """Output data rate is controlled by ODR registers. Four data update
@@ -249,18 +431,11 @@ class QMC5883L:
 
         """
 
-        rates = (
-            "OUTPUT_DATA_RATE_10",
-            "OUTPUT_DATA_RATE_50",
-            "OUTPUT_DATA_RATE_100",
-            "OUTPUT_DATA_RATE_200",
-        )
-
-        return rates[self._output_data_rate]
+        return _DATA_RATE_NAMES[self._output_data_rate]
 
     @output_data_rate.setter
     def output_data_rate(self, value: int) -> None:
-        if value not in data_rate_values:
+        if value not in _DATA_RATE_SET:
             raise ValueError("Value must be a valid data rate setting")
 
         self._output_data_rate = value
@@ -297,21 +472,307 @@ class QMC5883L:
             qmc.output_data_rate = qmc5883l.MODE_STANDBY
 
         """
-        modes = ("MODE_STANDBY", "MODE_CONTINUOUS")
 
-        return modes[self._mode_control]
+        return _MODE_NAMES[self._mode_control]
 
     @mode_control.setter
     def mode_control(self, value: int) -> None:
-        if value not in mode_values:
+        if value not in _MODE_SET:
             raise ValueError("Value must be a valid mode setting")
         self._mode_control = value
 
+    def configure(
+        self,
+        oversample: int = None,
+        field_range: int = None,
+        output_data_rate: int = None,
+        mode_control: int = None,
+    ) -> None:
+        """Set several operation mode settings with a single register write.
+        Settings left as `None` keep their current value. See :attr:`oversample`,
+        :attr:`field_range`, :attr:`output_data_rate` and :attr:`mode_control`
+        for the accepted values.
+
+        Example
+        ---------------------
+
+        .. code-block:: python
+
+            i2c = board.I2C()
+            qmc = qmc5883l.QMC5883L(i2c)
+
+
+            qmc.configure(
+                oversample=qmc5883l.OVERSAMPLE_512,
+                output_data_rate=qmc5883l.OUTPUT_DATA_RATE_10,
+            )
+
+        """
+        opmode = self._compose_opmode(
+            self._opmode, oversample, field_range, output_data_rate, mode_control
+        )
+
+        if field_range is not None:
+            self._set_resolution(field_range)
+        self._opmode = opmode
+        self._i2c.writeto_mem(self._address, _REG_OPERATION_MODE, bytes((opmode,)))
+
+    @staticmethod
+    def _compose_opmode(
+        opmode: int,
+        oversample: int,
+        field_range: int,
+        output_data_rate: int,
+        mode_control: int,
+    ) -> int:
+        # The field layout comes from the ShadowBits descriptors
+        for value, values, field, name in (
+            (oversample, _OVERSAMPLE_SET, QMC5883L._oversample, "oversample"),
+            (field_range, _FIELD_RANGE_SET, QMC5883L._field_range, "field range"),
+            (
+                output_data_rate,
+                _DATA_RATE_SET,
+                QMC5883L._output_data_rate,
+                "data rate",
+            ),
+            (mode_control, _MODE_SET, QMC5883L._mode_control, "mode"),
+        ):
+            if value is None:
+                continue
+            if value not in values:
+                raise ValueError(f"Value must be a valid {name} setting")
+            opmode = (opmode & ~field.bit_mask) | (value << field.start_bit)
+
+        return opmode
+
     @property
     def magnetic(self):
         """Magnetic property"""
-        while self._data_ready_register != 1:
-            time.sleep(0.001)
-        x, y, z, _, _ = self._measures
+        return self._read()
+
+    def magnetic_nowait(self):
+        """Magnetic values without waiting for a new sample. When the sensor has
+        no new data, the last reading is returned instead.
+
+        The cache follows ``max_age``: while the cached reading is younger than
+        ``max_age`` milliseconds and DRDY is not set, it is returned without
+        touching the bus. Otherwise one burst read is tried, updating the cache
+        if the sample was ready. ``max_age=-1`` means the user controls fetch:
+        the cache is only refreshed by :attr:`magnetic`.
+
+        The first call blocks until a sample is available.
+
+        .. code-block:: python
+
+            mag_x, mag_y, mag_z = qmc.magnetic_nowait()
+
+        """
+        last = self._last
+        if last is None:
+            return self.magnetic
+        if self._max_age < 0:
+            return last[:3]
+        if self._ready:
+            self._ready = False
+            return self._read_burst()
+        age = time.ticks_diff(time.ticks_ms(), last[3])  # pylint: disable=no-member
+        if age < self._max_age:
+            return last[:3]
+
+        if self._try_read():
+            return self._update(*struct.unpack_from("<hhh", self._buf))
+
+        return last[:3]
+
+    def magnetic_fixed(self):
+        """Magnetic values as integers in Q24 fixed point gauss (divide by
+        ``1 << 24`` to get gauss). Scaling is one integer multiplication per
+        axis, which avoids software floating point on MCUs without an FPU,
+        so prefer it over :attr:`magnetic` there for high data rates.
+
+        .. code-block:: python
+
+            mag_x, mag_y, mag_z = qmc.magnetic_fixed()
+
+        """
+        x, y, z = self._read_raw()
+        mul = self._q
+
+        return x * mul, y * mul, z * mul
+
+    def magnetic_batch(self, n: int):
+        """Read ``n`` consecutive samples, waiting for each one, into three
+        ``array('f')``, one per axis, of values in gauss.
+
+        .. code-block:: python
+
+            x_values, y_values, z_values = qmc.magnetic_batch(20)
+            mag_x, mag_y, mag_z = x_values[0], y_values[0], z_values[0]
+
+        """
+        x_values = array.array("f", [0.0] * n)
+        y_values = array.array("f", [0.0] * n)
+        z_values = array.array("f", [0.0] * n)
+        self._fill_batch(n, x_values, y_values, z_values, self._inv_resolution)
+
+        return x_values, y_values, z_values
+
+    def _fill_batch(self, n: int, x_values, y_values, z_values, inv) -> None:
+        read_raw = self._read_raw
+        for i in range(n):
+            x, y, z = read_raw()
+            x_values[i] = x * inv
+            y_values[i] = y * inv
+            z_values[i] = z * inv
+
+    def set_calibration(self, bias, soft_iron=None) -> None:
+        """Hard and soft iron correction used by :meth:`magnetic_calibrated_batch`.
+        Requires ``ulab``.
+
+        :param bias: Hard iron offset ``(x, y, z)`` in gauss
+        :param soft_iron: 3x3 soft iron correction matrix. Defaults to the identity
+
+        .. code-block:: python
+
+            qmc.set_calibration((0.12, -0.05, 0.3))
+
+        """
+        if np is None:
+            raise RuntimeError("Calibration requires ulab")
+        self._bias = np.array(bias).reshape((3, 1))
+        self._soft_iron = np.eye(3) if soft_iron is None else np.array(soft_iron)
+
+    def magnetic_calibrated_batch(self, n: int):
+        """Read ``n`` consecutive samples and return them as a 3xN ``ulab``
+        ndarray in gauss, corrected with the values given to
+        :meth:`set_calibration`. The correction is applied as vector operations
+        over the whole batch. Requires ``ulab``.
+
+        .. code-block:: python
+
+            qmc.set_calibration((0.12, -0.05, 0.3))
+            values = qmc.magnetic_calibrated_batch(50)
+            mag_x = values[0]
+
+        """
+        if np is None:
+            raise RuntimeError("Calibration requires ulab")
+        if self._bias is None:
+            self.set_calibration((0, 0, 0))
+        # One contiguous int16 buffer, x then y then z, wrapped without copying
+        samples = array.array("h", [0] * (3 * n))
+        view = memoryview(samples)
+        self._fill_batch(n, view[:n], view[n : 2 * n], view[2 * n :], 1)
+        raw = np.frombuffer(samples, dtype=np.int16).reshape((3, n))
+
+        return np.dot(self._soft_iron, raw * self._inv_resolution - self._bias)
+
+    async def magnetic_async(self):
+        """Magnetic values, yielding to other tasks while the sensor is
+        converting. With ``drdy_pin`` it awaits the DRDY interrupt, otherwise it
+        polls STATUS with a 1 ms ``asyncio`` sleep between tries.
 
-        return x / self.resolution, y / self.resolution, z / self.resolution
+        .. code-block:: python
+
+            mag_x, mag_y, mag_z = await qmc.magnetic_async()
+
+        """
+        if self._drdy_flag is None:
+            readinto = self._i2c.readfrom_mem_into
+            address = self._address
+            status = self._status
+            readinto(address, _REG_STATUS, status)
+            while not status[0] & _DATA_READY:
+                await asyncio.sleep_ms(1)
+                readinto(address, _REG_STATUS, status)
+            readinto(address, _REG_DATA, self._buf)
+
+            return self._update(*struct.unpack_from("<hhh", self._buf))
+
+        while not self._ready:
+            await self._drdy_flag.wait()
+        self._ready = False
+
+        return self._read_burst()
+
+    def samples(self, n: int):
+        """Latest ``n`` samples captured in the ring buffer, oldest first, without
+        any I2C traffic. Fewer samples are returned if the buffer holds less
+        than ``n``. Samples are scaled with the current field range.
+
+        .. code-block:: python
+
+            qmc = qmc5883l.QMC5883L(i2c, drdy_pin=4, buffer_size=32)
+            for mag_x, mag_y, mag_z in qmc.samples(10):
+                print(mag_x, mag_y, mag_z)
+
+        """
+        n, (x_values, y_values, z_values) = self._snapshot(n)
+        inv = self._inv_resolution
+        values = []
+        for i in range(n):
+            values.append((x_values[i] * inv, y_values[i] * inv, z_values[i] * inv))
+
+        return values
+
+    def samples_fixed(self, n: int):
+        """Latest ``n`` samples captured in the ring buffer, oldest first, as
+        three ``array('i')``, one per axis, in Q24 fixed point gauss (divide by
+        ``1 << 24`` to get gauss). Scaling runs in a viper loop where the port
+        supports it, with no per value allocation.
+
+        .. code-block:: python
+
+            qmc = qmc5883l.QMC5883L(i2c, drdy_pin=4, buffer_size=32)
+            x_values, y_values, z_values = qmc.samples_fixed(10)
+            mag_x = x_values[0] / (1 << 24)
+
+        """
+        n, raw = self._snapshot(n)
+        axes = (
+            array.array("i", [0] * n),
+            array.array("i", [0] * n),
+            array.array("i", [0] * n),
+        )
+        mul = self._q
+        for src, out in zip(raw, axes):
+            _scale(src, out, n, mul)
+
+        return axes
+
+    def _snapshot(self, n: int):
+        # Copy the latest n samples in order with interrupts held off, so the
+        # DRDY callback cannot move the head or rewrite a slot halfway through
+        size = self._ring_size
+        state = disable_irq()
+        try:
+            n = max(0, min(n, self._count))
+            start = (self._head - n) % size if size else 0
+            end = start + n
+            if end <= size:
+                raw = tuple(values[start:end] for values in self.as_soa())
+            else:
+                end -= size
+                raw = tuple(values[start:] + values[:end] for values in self.as_soa())
+        finally:
+            enable_irq(state)
+
+        return n, raw
+
+    def as_soa(self):
+        """Raw int16 ring buffer arrays ``(x_values, y_values, z_values)``, one
+        per axis, shared with the DRDY interrupt rather than copied. Until the
+        buffer wraps, samples fill indices from 0 upwards; after that the oldest
+        sample is the next one to be overwritten. The interrupt keeps writing
+        to these arrays, so values are only consistent while DRDY is paused.
+        Use :meth:`samples` or :meth:`samples_fixed` for a consistent copy in
+        order.
+
+        .. code-block:: python
+
+            qmc = qmc5883l.QMC5883L(i2c, drdy_pin=4, buffer_size=32)
+            x_values, y_values, z_values = qmc.as_soa()
+            offset_x = (max(x_values) + min(x_values)) / 2 / qmc.resolution
+
+        """
+        return self._xs, self._ys, self._zs
@@ -0,0 +1,28 @@
+# SPDX-FileCopyrightText: Copyright (c) 2023 Jose D. Montoya
+#
+# SPDX-License-Identifier: MIT
+"""
+`viper_helpers`
+================================================================================
+
+Viper helpers for the sample scaling inner loops. Only importable on ports with
+the native emitter.
+
+
+* Author(s): Jose D. Montoya
+
+
+"""
+# pylint: disable=undefined-variable
+import micropython
+
+
+@micropython.viper
+def scale(src: ptr16, out: ptr32, n: int, mul: int):
+    """Sign extend ``n`` int16 values from ``src`` and scale them by the fixed
+    point multiplier ``mul`` into ``out``"""
+    for i in range(n):
+        raw = src[i]
+        if raw & 0x8000:
+            raw -= 0x10000
+        out[i] = raw * mul